@@ -1,13 +1,22 @@
 import os
 import psycopg2
-import psycopg2.extras
 from flask import Flask, jsonify, request, send_from_directory, render_template, make_response, redirect
 from dotenv import load_dotenv
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import datetime
+import hmac
 import traceback
-import decimal
 import json
+import re
+import tempfile
+import threading
+import unicodedata
+
+import banco
+from metricas import metricas
+from protecao import EsperaEsgotada, controle_de_carga, singleflight
+from snapshot import SnapshotCompartilhado, escrever_snapshot
 
 # --- INÍCIO DA SEÇÃO DO CHATBOT ---
 import google.generativeai as genai
@@ -34,87 +43,93 @@ except Exception as e:
 # Inicializa o aplicativo Flask
 app = Flask(__name__, static_folder='.', static_url_path='', template_folder='templates')
 CORS(app)
-
-def get_db_connection():
-    """Cria e retorna uma conexão com o banco de dados PostgreSQL."""
-    conn = None
-    try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-        return conn
-    except Exception as e:
-        print(f"ERRO CRÍTICO: Não foi possível conectar ao banco de dados: {e}")
-        raise
-
-def format_db_data(data_dict):
-    """Formata datas, horas e decimais de um dicionário para exibição em JSON/HTML."""
-    if not isinstance(data_dict, dict):
-        return data_dict
-
-    formatted_dict = {}
-    for key, value in data_dict.items():
-        if isinstance(value, datetime.date):
-            formatted_dict[key] = value.strftime('%d/%m/%Y') if value else None
-        elif isinstance(value, datetime.time):
-            formatted_dict[key] = value.strftime('%H:%M') if value else None
-        elif isinstance(value, decimal.Decimal):
-            try:
-                formatted_dict[key] = float(value)
-            except (TypeError, ValueError):
-                formatted_dict[key] = None
-        else:
-            formatted_dict[key] = value
-    return formatted_dict
+# No Render o app fica atrás de um proxy; usa só o IP que ele anexa ao X-Forwarded-For
+# (o último), já que o resto do cabeçalho vem do cliente
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+def to_slug(s):
+    """Converte um texto (ex: bairro) em slug de URL, sem acentos."""
+    if not s: return ''
+    s = unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
+
+
+# --- INÍCIO DA SEÇÃO DO SNAPSHOT DE DADOS ---
+# 'feiras', 'feiras_livres', o contexto do bot e os índices por slug/id ficam num
+# arquivo binário mapeado (mmap) por todos os workers, em vez de uma cópia por processo.
+CAMINHO_SNAPSHOT = os.getenv('SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'feiras-de-rua.snap'))
+SNAPSHOT_MAX_IDADE = int(os.getenv('SNAPSHOT_MAX_IDADE', 900))
+# Aumente ao mudar tabelas, índices, listas ou textos do snapshot: o arquivo antigo é regerado
+ESQUEMA_SNAPSHOT = 1
+
+# Campos das feiras que entram no contexto do chatbot
+CAMPOS_BOT_FEIRAS = ('id', 'nome_feira', 'tipo_feira', 'dia_semana', 'horario_inicio', 'horario_fim',
+                     'rua', 'regiao', 'bairro', 'descricao', 'latitude', 'longitude')
+CAMPOS_BOT_FEIRAS_LIVRES = ('id', 'nome_da_feira', 'dia_da_feira', 'endereco', 'bairro', 'latitude', 'longitude')
+
+def publicar_snapshot():
+    """Consulta o banco e publica uma nova versão do snapshot para todos os workers."""
+    with banco.iterar('feiras_todas') as registros:
+        feiras = [f._asdict() for f in registros]
+    with banco.iterar('feiras_livres_todas') as registros:
+        feiras_livres = [f._asdict() for f in registros]
+
+    # Contexto do bot sai das mesmas linhas, sem reler as tabelas
+    bot_feiras = [{campo: f.get(campo) for campo in CAMPOS_BOT_FEIRAS} for f in feiras]
+    bot_feiras_livres = [{campo: f.get(campo) for campo in CAMPOS_BOT_FEIRAS_LIVRES}
+                         for f in sorted(feiras_livres, key=lambda f: f.get('nome_da_feira') or '')]
+
+    for f in feiras_livres:
+        f['slug'] = to_slug(f.get('bairro', '')) or str(f.get('id', ''))
+
+    versao = escrever_snapshot(
+        CAMINHO_SNAPSHOT,
+        tabelas={'feiras': feiras, 'feiras_livres': feiras_livres},
+        indices={
+            'feiras.url': ('feiras', 'url'),
+            'feiras.id': ('feiras', 'id'),
+            'feiras_livres.slug': ('feiras_livres', 'slug'),
+            'feiras_livres.id': ('feiras_livres', 'id'),
+        },
+        listas={'feiras.tipos': sorted({f['tipo_feira'] for f in feiras if f.get('tipo_feira')})},
+        textos={
+            'bot.feiras_especiais': json.dumps(bot_feiras, separators=(',', ':')),
+            'bot.feiras_livres': json.dumps(bot_feiras_livres, separators=(',', ':')),
+        },
+        esquema=ESQUEMA_SNAPSHOT,
+    )
+    print(f"Snapshot de dados publicado: versão {versao}, {len(feiras)} feiras, {len(feiras_livres)} feiras livres.")
+
+snapshot_dados = SnapshotCompartilhado(CAMINHO_SNAPSHOT, publicar_snapshot, max_idade=SNAPSHOT_MAX_IDADE,
+                                      esquema=ESQUEMA_SNAPSHOT)
+
+@app.cli.command('publicar-snapshot')
+def publicar_snapshot_command():
+    """Gera e publica um novo snapshot de dados (flask --app app publicar-snapshot)."""
+    snapshot_dados.publicar()
+
+# Mapeia (ou publica, se ainda não existir) o snapshot já na subida do worker
+print("Carregando o snapshot de dados das feiras...")
+try:
+    snapshot_dados.atual()
+except Exception as e:
+    print(f"ERRO CRÍTICO ao carregar o snapshot de dados: {e}")
+    traceback.print_exc()
+# --- FIM DA SEÇÃO DO SNAPSHOT DE DADOS ---
 
 
 # --- INÍCIO DA SEÇÃO DO CHATBOT ---
 
-def get_all_data_for_bot():
-    """
-    Busca dados das tabelas 'feiras' e 'feiras_livres' para alimentar o chatbot.
-    """
-    all_data = {}
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cur.execute("""
-            SELECT id, nome_feira, tipo_feira, dia_semana, horario_inicio, horario_fim, 
-                   rua, regiao, bairro, descricao, latitude, longitude 
-            FROM feiras ORDER BY nome_feira
-        """)
-        feiras_raw = cur.fetchall()
-        all_data['feiras_especiais'] = [format_db_data(dict(f)) for f in feiras_raw]
-        
-        cur.execute("""
-            SELECT id, nome_da_feira, dia_da_feira, endereco, bairro, latitude, longitude
-            FROM feiras_livres ORDER BY nome_da_feira
-        """)
-        feiras_livres_raw = cur.fetchall()
-        all_data['feiras_livres'] = [format_db_data(dict(f)) for f in feiras_livres_raw]
-        
-        cur.close()
-        print(f"Dados do Bot carregados: {len(all_data['feiras_especiais'])} feiras especiais, {len(all_data['feiras_livres'])} feiras livres.")
-        return all_data
-    except Exception as e:
-        print(f"ERRO CRÍTICO ao buscar dados para o bot: {e}")
-        traceback.print_exc()
-        return None
-    finally:
-        if conn: conn.close()
-
-
-print("Buscando dados das feiras no DB para inicializar o bot...")
-bot_data = get_all_data_for_bot()
-
 model = None
 chat_session = None
 
-if bot_data:
-    feiras_especiais_json = json.dumps(bot_data['feiras_especiais'], separators=(',', ':'))
-    feiras_livres_json = json.dumps(bot_data['feiras_livres'], separators=(',', ':'))
-    
-    SYSTEM_PROMPT = f"""
+# A sessão do chat é uma só por processo; com o gunicorn em threads as mensagens
+# precisam passar uma de cada vez. Quem espera demais recebe 503 em vez de enfileirar.
+chat_lock = threading.Lock()
+CHAT_ESPERA_MAX = float(os.getenv('CHAT_ESPERA_MAX', 5))
+
+# Preenchido com os JSONs do snapshot só quando a sessão do chat é criada
+SYSTEM_PROMPT = """
 Você é o "Feirinha - Chatbot", o assistente virtual especialista do site feirasderua.com.br.
 Sua missão é ajudar os usuários a encontrar feiras em São Paulo USANDO APENAS A BASE DE DADOS FORNECIDA.
 
@@ -141,15 +156,27 @@ LISTA 2: Feiras Livres (Tradicionais. Tabela 'feiras_livres')
 {feiras_livres_json}
 --- FIM DA BASE DE DADOS ---
 """
-    
-    try:
+
+def _get_chat_session():
+    """
+    Cria a sessão do chat na primeira mensagem deste worker (chamar com chat_lock).
+
+    O prompt é montado a partir do texto mapeado do snapshot e só fica guardado no
+    histórico da sessão; workers que nunca recebem chat não carregam o contexto.
+    """
+    global model, chat_session
+    if chat_session is None:
+        snapshot = snapshot_dados.atual()
         model = genai.GenerativeModel('gemini-flash-latest') 
         
         chat_session = model.start_chat(
             history=[
                 {
                     "role": "user",
-                    "parts": [SYSTEM_PROMPT]
+                    "parts": [SYSTEM_PROMPT.format(
+                        feiras_especiais_json=snapshot.texto('bot.feiras_especiais'),
+                        feiras_livres_json=snapshot.texto('bot.feiras_livres'),
+                    )]
                 },
                 {
                     "role": "model",
@@ -158,22 +185,12 @@ LISTA 2: Feiras Livres (Tradicionais. Tabela 'feiras_livres')
             ]
         )
         print("Modelo 'gemini-flash-latest' inicializado com SUCESSO e alimentado com os dados do DB.")
-
-    except Exception as e:
-        print(f"ERRO CRÍTICO: Não foi possível inicializar o GenerativeModel. {e}")
-        traceback.print_exc()
-else:
-    print("ERRO CRÍTICO: Não foi possível buscar dados do DB para o bot. O chat não vai funcionar.")
-    model = None
-    chat_session = None
+    return chat_session
 
 
 @app.route('/api/chat', methods=['POST'])
+@controle_de_carga('chat', coalescer=False)
 def handle_chat():
-    if not model or not chat_session:
-        print("Erro: A sessão do chat com o Gemini não foi inicializada.")
-        return jsonify({'error': 'Serviço de chat indisponível no momento.'}), 503
-
     try:
         data = request.json
         user_message = data.get('message')
@@ -181,18 +198,31 @@ def handle_chat():
         if not user_message:
             return jsonify({'error': 'Mensagem não pode ser vazia.'}), 400
 
-        response = chat_session.send_message(
-            user_message,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7 
-            ),
-            safety_settings={
-                 'HATE': 'BLOCK_NONE',
-                 'HARASSMENT': 'BLOCK_NONE',
-                 'SEXUAL' : 'BLOCK_NONE',
-                 'DANGEROUS' : 'BLOCK_NONE'
-            }
-        )
+        if not chat_lock.acquire(timeout=CHAT_ESPERA_MAX):
+            metricas.incrementar('descartadas.chat.ocupado')
+            return jsonify({'error': 'Chat ocupado no momento. Tente novamente em instantes.'}), 503
+        try:
+            try:
+                sessao = _get_chat_session()
+            except Exception as e:
+                print(f"Erro: A sessão do chat com o Gemini não pôde ser inicializada: {e}")
+                traceback.print_exc()
+                return jsonify({'error': 'Serviço de chat indisponível no momento.'}), 503
+
+            response = sessao.send_message(
+                user_message,
+                generation_config=genai.types.GenerationConfig(
+                    temperature=0.7 
+                ),
+                safety_settings={
+                     'HATE': 'BLOCK_NONE',
+                     'HARASSMENT': 'BLOCK_NONE',
+                     'SEXUAL' : 'BLOCK_NONE',
+                     'DANGEROUS' : 'BLOCK_NONE'
+                }
+            )
+        finally:
+            chat_lock.release()
 
         return jsonify({'reply': response.text})
 
@@ -212,6 +242,15 @@ def handle_chat():
 #  HELPER: BUSCAR ANÚNCIO ATIVO
 # ─────────────────────────────────────────
 def _get_anuncio_feiras(posicao, bairro=None):
+    """Busca um anúncio ativo, juntando buscas idênticas que já estão em andamento."""
+    chave = ('anuncio', posicao, (bairro or '').lower())
+    try:
+        return singleflight.executar(chave, lambda: _buscar_anuncio_feiras(posicao, bairro))
+    except EsperaEsgotada:
+        # A página sai sem anúncio em vez de ficar presa esperando o banco
+        return None
+
+def _buscar_anuncio_feiras(posicao, bairro=None):
     """
     Busca um anúncio ativo da tabela 'anuncios' com rotação por RANDOM().
 
@@ -225,62 +264,24 @@ def _get_anuncio_feiras(posicao, bairro=None):
     3. Usa RANDOM() para rotação de anúncios
     4. Respeita data_inicio e data_fim
     """
-    conn = None
     try:
-        from datetime import date
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        hoje = date.today()
-        
+        hoje = datetime.date.today()
+
         # Primeiro: tenta buscar anúncio específico do bairro
         if bairro:
-            cur.execute("""
-                SELECT id, titulo, foto_url, link, posicao, data_inicio, data_fim, ativo, bairro
-                FROM anuncios
-                WHERE 
-                    posicao = %s 
-                    AND ativo = true
-                    AND LOWER(bairro) = LOWER(%s)
-                    AND (data_inicio IS NULL OR data_inicio <= %s)
-                    AND (data_fim IS NULL OR data_fim >= %s)
-                ORDER BY RANDOM()
-                LIMIT 1
-            """, (posicao, bairro, hoje, hoje))
-            
-            row = cur.fetchone()
-            if row:
-                cur.close()
-                return format_db_data(dict(row))
-        
+            anuncio = banco.buscar_um('anuncio_bairro', posicao, bairro, hoje)
+            if anuncio:
+                return anuncio
+
         # Se não achou bairro-específico, busca anúncios "Global" com rotação
-        cur.execute("""
-            SELECT id, titulo, foto_url, link, posicao, data_inicio, data_fim, ativo, bairro
-            FROM anuncios
-            WHERE 
-                posicao = %s 
-                AND ativo = true
-                AND (bairro IS NULL OR bairro = '')
-                AND (data_inicio IS NULL OR data_inicio <= %s)
-                AND (data_fim IS NULL OR data_fim >= %s)
-            ORDER BY RANDOM()
-            LIMIT 1
-        """, (posicao, hoje, hoje))
-        
-        row = cur.fetchone()
-        cur.close()
-        
-        if row:
-            return format_db_data(dict(row))
-        return None
-        
+        return banco.buscar_um('anuncio_global', posicao, hoje)
+
     except Exception as e:
         print(f"ERRO em _get_anuncio_feiras('{posicao}', bairro='{bairro}'): {e}")
         return None
-    finally:
-        if conn: conn.close()
 
 @app.route('/index.html')
+@controle_de_carga('paginas')
 def index_html_route():
     # Rota explícita para /index.html — necessária pois o arquivo está em /templates/
     return render_template('index.html', 
@@ -288,66 +289,34 @@ def index_html_route():
                           anuncio_meio=_get_anuncio_feiras('meio'))
 # --- NOVA ROTA PARA FEIRAS LIVRES ---
 @app.route('/api/feiras_livres')
+@controle_de_carga('paginas')
 def get_api_feiras_livres():
-    """Retorna uma lista JSON de todas as feiras livres da tabela 'feiras_livres'."""
-    conn = None
+    """Retorna uma lista JSON de todas as feiras livres (snapshot da tabela 'feiras_livres')."""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        query = """
-        SELECT id, nome_da_feira, dia_da_feira, categoria, qnt_feirantes, 
-               endereco, bairro, latitude, longitude
-        FROM feiras_livres
-        ORDER BY dia_da_feira, nome_da_feira;
-        """
-        
-        cur.execute(query)
-        feiras_raw = cur.fetchall()
-        cur.close()
-
-        feiras_processadas = [format_db_data(dict(feira)) for feira in feiras_raw]
-
-        import re, unicodedata
-        def to_slug(s):
-            if not s: return ''
-            s = unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode()
-            return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
-        for f in feiras_processadas:
-            f['slug'] = to_slug(f.get('bairro', '')) or str(f.get('id', ''))
-
+        campos = ('id', 'nome_da_feira', 'dia_da_feira', 'categoria', 'qnt_feirantes',
+                  'endereco', 'bairro', 'latitude', 'longitude', 'slug')
+        feiras_livres = snapshot_dados.atual().tabela('feiras_livres')
+        feiras_processadas = [{campo: feira.get(campo) for campo in campos} for feira in feiras_livres.linhas()]
         return jsonify(feiras_processadas)
         
-    except psycopg2.errors.UndefinedTable:
-        print("ERRO: A tabela 'feiras_livres' não foi encontrada no banco de dados.")
-        return jsonify({'error': 'Tabela feiras_livres não encontrada.'}), 500
     except Exception as e:
         print(f"ERRO no endpoint /api/feiras_livres: {e}")
         traceback.print_exc()
         return jsonify({'error': 'Erro interno ao buscar feiras livres.'}), 500
-    finally:
-        if conn: conn.close()
 
 
 # --- ROTA PARA BUSCAR POSTS DO BLOG (API) ---
 @app.route('/api/blog')
+@controle_de_carga('paginas')
 def get_api_blog():
     """Retorna uma lista JSON de todos os posts da tabela 'blog'."""
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        query = "SELECT * FROM blog ORDER BY data_publicacao DESC, id DESC;"
-        
-        cur.execute(query)
-        posts_raw = cur.fetchall()
-        cur.close()
-
-        posts_processados = [format_db_data(dict(post)) for post in posts_raw]
+        posts_processados = [post._asdict() for post in banco.buscar_todos('blog_todos')]
 
         return jsonify(posts_processados)
         
+    except banco.BancoOcupado:
+        return jsonify({'error': 'Servidor ocupado. Tente novamente em instantes.'}), 503
     except psycopg2.errors.UndefinedTable:
         print("ERRO: A tabela 'blog' não foi encontrada no banco de dados.")
         return jsonify({'error': 'Tabela blog não encontrada.'}), 500
@@ -355,75 +324,53 @@ def get_api_blog():
         print(f"ERRO no endpoint /api/blog: {e}")
         traceback.print_exc()
         return jsonify({'error': 'Erro interno ao buscar posts do blog.'}), 500
-    finally:
-        if conn: conn.close()
 
 # --- ROTAS DE DETALHE DE CONTEÚDO (DEVE VIR ANTES DA ROTA ESTÁTICA) ---
 
 # ROTA PARA RENDERIZAR UMA PÁGINA DE POST DO BLOG
 @app.route('/blog/<slug>')
+@controle_de_carga('paginas')
 def blog_post_detalhe(slug):
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        cur.execute('SELECT * FROM blog WHERE slug = %s;', (slug,))
-        post = cur.fetchone()
-        cur.close()
+        post = banco.buscar_um('blog_por_slug', slug)
 
         if post:
-            post_formatado = format_db_data(dict(post))
-            return render_template('post-detalhe.html', post=post_formatado)
+            return render_template('post-detalhe.html', post=post)
         else:
             print(f"AVISO: Post do blog com slug '{slug}' não encontrado.")
             return "Post não encontrado", 404
             
+    except banco.BancoOcupado:
+        return "Servidor ocupado. Tente novamente em instantes.", 503
     except Exception as e:
         print(f"ERRO na rota /blog/{slug}: {e}")
         traceback.print_exc()
         return "Erro ao carregar a página do post", 500
-    finally:
-        if conn: conn.close()
         
 # ROTA DE DETALHE ÚNICA PARA FEIRAS
 @app.route('/feiras/<path:slug>') 
+@controle_de_carga('paginas')
 def feira_detalhe(slug):
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        feiras = snapshot_dados.atual().tabela('feiras')
 
         # ✅ SEO: Se o slug for numérico (ID antigo), redireciona 301 para a URL com slug correto
         if slug.isdigit():
-            cur.execute('SELECT url FROM feiras WHERE CAST(id AS VARCHAR) = %s AND url IS NOT NULL AND url != \'\';', (slug,))
-            row = cur.fetchone()
-            cur.close()
-            if row and row['url']:
-                print(f"SEO 301: Redirecionando /feiras/{slug} → /feiras/{row['url']}")
-                return redirect(f"/feiras/{row['url']}", code=301)
-            else:
+            feira = feiras.buscar('feiras.id', slug)
+            if feira and feira['url']:
+                print(f"SEO 301: Redirecionando /feiras/{slug} → /feiras/{feira['url']}")
+                return redirect(f"/feiras/{feira['url']}", code=301)
+            elif feira:
                 # ID sem slug cadastrado — renderiza normalmente pelo ID
-                conn2 = get_db_connection()
-                cur2 = conn2.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                cur2.execute('SELECT * FROM feiras WHERE CAST(id AS VARCHAR) = %s;', (slug,))
-                feira = cur2.fetchone()
-                cur2.close()
-                conn2.close()
-                if feira:
-                    feira_formatada = format_db_data(dict(feira))
-                    return render_template('feira-detalhe.html', feira=feira_formatada)
-                else:
-                    return "Feira não encontrada", 404
+                return render_template('feira-detalhe.html', feira=feira)
+            else:
+                return "Feira não encontrada", 404
 
         # Busca pelo campo 'url' (slug)
-        cur.execute('SELECT * FROM feiras WHERE url = %s;', (slug,))
-        feira = cur.fetchone()
-        cur.close()
+        feira = feiras.buscar('feiras.url', slug)
 
         if feira:
-            feira_formatada = format_db_data(dict(feira))
-            return render_template('feira-detalhe.html', feira=feira_formatada)
+            return render_template('feira-detalhe.html', feira=feira)
         else:
             print(f"AVISO: Feira com slug/url '{slug}' não encontrada.")
             return "Feira não encontrada", 404
@@ -432,56 +379,30 @@ def feira_detalhe(slug):
         print(f"ERRO na rota /feiras/{slug}: {e}")
         traceback.print_exc()
         return "Erro ao carregar a página da feira", 500
-    finally:
-        if conn: conn.close()
 
 
 # --- ROTAS DE API ---
 
 @app.route('/api/feiras/tipos')
+@controle_de_carga('paginas')
 def get_tipos_feira():
     """Retorna uma lista JSON com todos os valores únicos de 'tipo_feira'."""
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT tipo_feira FROM feiras WHERE tipo_feira IS NOT NULL AND tipo_feira != '' ORDER BY tipo_feira;")
-        tipos = [row[0] for row in cur.fetchall()]
-        cur.close()
-        return jsonify(tipos)
+        return jsonify(snapshot_dados.atual().lista('feiras.tipos'))
     except Exception as e:
         print(f"ERRO em /api/feiras/tipos: {e}")
         traceback.print_exc()
         return jsonify({'error': 'Erro ao buscar tipos de feira'}), 500
-    finally:
-        if conn: conn.close()
 
 
 @app.route('/api/feiras')
+@controle_de_carga('paginas', parametros=('tipo',))
 def get_api_feiras():
-    conn = None
     try:
         tipo_feira_filtro = request.args.get('tipo')
-        
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-        query = "SELECT *, CAST(id AS VARCHAR) as effective_slug FROM feiras"
-        params = []
-
-        if tipo_feira_filtro:
-            query += " WHERE tipo_feira ILIKE %s"
-            params.append(f"%{tipo_feira_filtro}%")
-
-        query += " ORDER BY nome_feira;"
-
-        cur.execute(query, tuple(params))
-        feiras_raw = cur.fetchall()
-        cur.close()
 
         feiras_processadas = []
-        for feira in feiras_raw:
-            feira_dict = format_db_data(dict(feira))
+        for feira_dict in _feiras_do_tipo(tipo_feira_filtro):
             feira_slug = feira_dict.get('url') if feira_dict.get('url') else feira_dict.get('id')
             feira_dict['url'] = f'/feiras/{feira_slug}'
             feira_dict['effective_slug'] = feira_dict['id']
@@ -493,40 +414,23 @@ def get_api_feiras():
         print(f"ERRO no endpoint /api/feiras: {e}")
         traceback.print_exc()
         return jsonify({'error': 'Erro interno ao buscar feiras.'}), 500
-    finally:
-        if conn: conn.close()
+
+def _feiras_do_tipo(tipo_feira=None):
+    """Feiras do snapshot (já ordenadas por nome), filtradas como o antigo 'tipo_feira ILIKE %tipo%'."""
+    feiras = snapshot_dados.atual().tabela('feiras')
+    if not tipo_feira:
+        return list(feiras.linhas())
+    filtro = tipo_feira.casefold()
+    return [feiras.linha(i) for i in range(len(feiras))
+            if filtro in (feiras.valor(i, 'tipo_feira') or '').casefold()]
         
 @app.route('/feira-livre/<slug>')
+@controle_de_carga('paginas')
 def feira_livre_detalhe(slug):
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        # Busca todas e filtra pelo slug em Python (sem UNACCENT)
-        cur.execute("SELECT * FROM feiras_livres")
-        todas = cur.fetchall()
-        cur.close()
-
-        import re, unicodedata
-        def to_slug(s):
-            if not s: return ''
-            s = unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode()
-            return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
-
-        feira = None
-        for row in todas:
-            row = dict(row)
-            if to_slug(row.get('bairro', '')) == slug:
-                feira = row
-                break
-
-        # fallback por id
-        if not feira:
-            for row in todas:
-                row = dict(row)
-                if str(row.get('id', '')) == slug:
-                    feira = row
-                    break
+        feiras_livres = snapshot_dados.atual().tabela('feiras_livres')
+        # Índices do snapshot: slug do bairro e, como fallback, o id
+        feira = feiras_livres.buscar('feiras_livres.slug', slug) or feiras_livres.buscar('feiras_livres.id', slug)
 
         if not feira:
             return "Feira não encontrada", 404
@@ -541,45 +445,36 @@ def feira_livre_detalhe(slug):
     except Exception as e:
         print(f"ERRO em /feira-livre/{slug}: {e}")
         return "Erro interno", 500
-    finally:
-        if conn: conn.close()
 
 
 # --- ROTAS DE COMPATIBILIDADE ---
 @app.route('/api/gastronomicas')
+@controle_de_carga('paginas')
 def get_gastronomicas_compat():
     return get_api_feiras_filtrado('Gastronômica')
 
 @app.route('/api/artesanais')
+@controle_de_carga('paginas')
 def get_artesanais_compat():
     return get_api_feiras_filtrado('Artesanal')
 
 def get_api_feiras_filtrado(tipo_feira):
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        query = "SELECT *, CAST(id AS VARCHAR) as effective_slug FROM feiras WHERE tipo_feira ILIKE %s ORDER BY nome_feira;"
-        cur.execute(query, (f"%{tipo_feira}%",))
-        feiras_raw = cur.fetchall()
-        cur.close()
-        
         feiras_processadas = []
-        for feira in feiras_raw:
-            feira_dict = format_db_data(dict(feira))
+        for feira_dict in _feiras_do_tipo(tipo_feira):
             feira_slug = feira_dict.get('url') if feira_dict.get('url') else feira_dict.get('id')
             feira_dict['url'] = f'/feiras/{feira_slug}'
+            feira_dict['effective_slug'] = str(feira_dict['id'])
             feiras_processadas.append(feira_dict)
         return jsonify(feiras_processadas)
 
     except Exception as e:
         print(f"ERRO em rota de compatibilidade: {e}")
         return jsonify({'error': 'Erro interno.'}), 500
-    finally:
-        if conn: conn.close()
 
 
 @app.route('/feiras-livres.html')
+@controle_de_carga('paginas')
 def feiras_livres_page():
     return render_template('feiras-livres.html', 
                           anuncio_topo=_get_anuncio_feiras('topo'), 
@@ -599,6 +494,7 @@ def pagina_sao_bernardo():
 # --- ROTAS PARA SERVIR ARQUIVOS ESTÁTICOS ---
 
 @app.route('/')
+@controle_de_carga('paginas')
 def index_route():
     return render_template('index.html', 
                           anuncio_topo=_get_anuncio_feiras('topo'), 
@@ -618,6 +514,21 @@ def serve_static_files(path):
         return "Not Found", 404
 
 
+# --- ROTA DE MÉTRICAS ---
+# Sem METRICAS_TOKEN definido a rota fica desligada (404): os tempos sql.* não são públicos
+METRICAS_TOKEN = os.getenv('METRICAS_TOKEN')
+
+@app.route('/api/metricas')
+@controle_de_carga('paginas', coalescer=False)
+def get_metricas():
+    """Contadores deste processo: requisições descartadas, servidas obsoletas e coalescidas."""
+    token = request.headers.get('X-Metricas-Token', '')
+    if not METRICAS_TOKEN or not hmac.compare_digest(token.encode(), METRICAS_TOKEN.encode()):
+        return jsonify({'error': 'Não encontrado.'}), 404
+    return jsonify(metricas.resumo())
+# --- FIM DA ROTA DE MÉTRICAS ---
+
+
 # --- ROTA DO ADS.TXT ---
 @app.route('/ads.txt')
 def ads_txt():
@@ -627,8 +538,8 @@ def ads_txt():
 
 # --- ROTA DO SITEMAP ---
 @app.route('/sitemap.xml')
+@controle_de_carga('paginas')
 def sitemap():
-    conn = None
     hoje = datetime.date.today().isoformat()  # ✅ Data atual para o lastmod
 
     # Páginas estáticas com prioridade alta
@@ -644,36 +555,34 @@ def sitemap():
     # Páginas dinâmicas (feiras e blog)
     paginas_dinamicas = []
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        snapshot = snapshot_dados.atual()
 
         # ✅ SEO: Só inclui feiras que têm slug (url) preenchido — evita duplicatas com IDs
-        cur.execute("SELECT url FROM feiras WHERE url IS NOT NULL AND url != '';")
-        for row in cur.fetchall():
-            paginas_dinamicas.append((f'https://www.feirasderua.com.br/feiras/{row[0]}', '0.8', 'weekly'))
-
-        cur.execute("SELECT slug FROM blog WHERE slug IS NOT NULL AND slug != '';")
-        for row in cur.fetchall():
-            paginas_dinamicas.append((f'https://www.feirasderua.com.br/blog/{row[0]}', '0.7', 'weekly'))
+        for url in snapshot.chaves('feiras.url'):
+            paginas_dinamicas.append((f'https://www.feirasderua.com.br/feiras/{url}', '0.8', 'weekly'))
 
         # Páginas de detalhe de feiras livres
-        import re, unicodedata
-        def to_slug(s):
-            if not s: return ''
-            s = unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode()
-            return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
-
-        cur.execute("SELECT bairro FROM feiras_livres WHERE bairro IS NOT NULL AND bairro != '';")
-        for row in cur.fetchall():
-            slug = to_slug(row[0])
+        feiras_livres = snapshot.tabela('feiras_livres')
+        for i in range(len(feiras_livres)):
+            slug = to_slug(feiras_livres.valor(i, 'bairro'))
             if slug:
                 paginas_dinamicas.append((f'https://www.feirasderua.com.br/feira-livre/{slug}', '0.7', 'weekly'))
 
-        cur.close()
     except Exception as e:
         print(f"AVISO: Erro ao buscar URLs dinâmicas para o sitemap: {e}")
-    finally:
-        if conn: conn.close()
+
+    # O blog vem do banco. Com o pool cheio, 503 em vez de um sitemap sem os posts,
+    # que o controle_de_carga guardaria como a última versão boa
+    try:
+        with banco.iterar('blog_slugs') as posts:
+            for post in posts:
+                paginas_dinamicas.append((f'https://www.feirasderua.com.br/blog/{post.slug}', '0.7', 'weekly'))
+    except banco.BancoOcupado:
+        resposta = make_response("Servidor ocupado. Tente novamente em instantes.", 503)
+        resposta.headers['Retry-After'] = '5'
+        return resposta
+    except Exception as e:
+        print(f"AVISO: Erro ao buscar os posts do blog para o sitemap: {e}")
 
     xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
     xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
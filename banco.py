@@ -0,0 +1,321 @@
+"""
+Acesso ao PostgreSQL: todas as consultas do app, com nome, preparadas no servidor.
+
+Cada conexão do pool faz PREPARE de uma consulta na primeira vez que ela é usada e
+depois só EXECUTE. As linhas viram registros com __slots__ e as datas, horas e
+decimais já chegam formatados do typecaster da conexão, então nada disso acontece
+valor a valor no caminho da requisição. Leituras grandes usam cursor no servidor
+e são lidas em lotes.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+from metricas import metricas
+
+# Consultas preparadas. Parâmetros no formato do PREPARE ($1, $2, ...).
+CONSULTAS = {
+    'feiras_todas': "SELECT * FROM feiras ORDER BY nome_feira",
+    'feiras_livres_todas': "SELECT * FROM feiras_livres ORDER BY dia_da_feira, nome_da_feira",
+    'anuncio_bairro': """
+        SELECT id, titulo, foto_url, link, posicao, data_inicio, data_fim, ativo, bairro
+        FROM anuncios
+        WHERE
+            posicao = $1
+            AND ativo = true
+            AND LOWER(bairro) = LOWER($2)
+            AND (data_inicio IS NULL OR data_inicio <= $3)
+            AND (data_fim IS NULL OR data_fim >= $3)
+        ORDER BY RANDOM()
+        LIMIT 1
+    """,
+    'anuncio_global': """
+        SELECT id, titulo, foto_url, link, posicao, data_inicio, data_fim, ativo, bairro
+        FROM anuncios
+        WHERE
+            posicao = $1
+            AND ativo = true
+            AND (bairro IS NULL OR bairro = '')
+            AND (data_inicio IS NULL OR data_inicio <= $2)
+            AND (data_fim IS NULL OR data_fim >= $2)
+        ORDER BY RANDOM()
+        LIMIT 1
+    """,
+    'blog_todos': "SELECT * FROM blog ORDER BY data_publicacao DESC, id DESC",
+    'blog_por_slug': "SELECT * FROM blog WHERE slug = $1",
+    'blog_slugs': "SELECT slug FROM blog WHERE slug IS NOT NULL AND slug != ''",
+}
+
+
+# --- Formatação no decode: o texto que vem do Postgres já é convertido no formato final ---
+
+def _data_br(valor, cur):
+    # 'AAAA-MM-DD' (ou timestamp 'AAAA-MM-DD HH:MM:SS') -> 'DD/MM/AAAA'
+    if valor is None:
+        return None
+    return f'{valor[8:10]}/{valor[5:7]}/{valor[0:4]}'
+
+def _hora(valor, cur):
+    # 'HH:MM:SS' -> 'HH:MM'
+    return None if valor is None else valor[:5]
+
+def _numero(valor, cur):
+    if valor is None:
+        return None
+    try:
+        return float(valor)
+    except ValueError:
+        return None
+
+_TYPECASTERS = [
+    psycopg2.extensions.new_type((1082, 1114, 1184), 'DATA_BR', _data_br),  # date, timestamp, timestamptz
+    psycopg2.extensions.new_type((1083, 1266), 'HORA', _hora),              # time, timetz
+    psycopg2.extensions.new_type((1700,), 'NUMERO', _numero),               # numeric
+]
+
+
+class _Conexao(psycopg2.extensions.connection):
+    """Conexão que lembra quais consultas já foram preparadas nela."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+        for tipo in _TYPECASTERS:
+            psycopg2.extensions.register_type(tipo, self)
+        self.autocommit = True
+
+
+class Registro:
+    """Base dos registros: acesso por atributo (templates) e por chave, como um dict."""
+    __slots__ = ()
+
+    def __init__(self, valores):
+        for campo, valor in zip(self.__slots__, valores):
+            object.__setattr__(self, campo, valor)
+
+    def __getitem__(self, campo):
+        return getattr(self, campo)
+
+    def get(self, campo, padrao=None):
+        return getattr(self, campo, padrao)
+
+    def _asdict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._asdict()!r})'
+
+_classes_registro = {}
+
+def _classe_registro(nome, descricao):
+    campos = tuple(coluna.name for coluna in descricao)
+    classe = _classes_registro.get((nome, campos))
+    if classe is None:
+        classe = type(f'Registro_{nome}', (Registro,), {'__slots__': campos})
+        _classes_registro[(nome, campos)] = classe
+    return classe
+
+
+class BancoOcupado(Exception):
+    """Todas as conexões do pool ficaram ocupadas além da espera máxima."""
+
+
+class _Pool:
+    """
+    Pool pequeno que mantém as conexões abertas (e com suas consultas preparadas).
+
+    Até 'tamanho' conexões em uso ao mesmo tempo; quem chega com todas ocupadas
+    espera no máximo 'espera' segundos e recebe BancoOcupado, em vez de enfileirar.
+    """
+
+    def __init__(self, dsn, tamanho, espera):
+        self._dsn = dsn
+        self._espera = espera
+        self._vagas = threading.BoundedSemaphore(tamanho)
+        self._lock = threading.Lock()
+        self._livres = []
+
+    def pegar(self):
+        if not self._vagas.acquire(timeout=self._espera):
+            metricas.incrementar('descartadas.banco')
+            raise BancoOcupado("Todas as conexões com o banco estão ocupadas.")
+        try:
+            with self._lock:
+                conn = self._livres.pop() if self._livres else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self._dsn, connection_factory=_Conexao)
+            return conn
+        except Exception:
+            self._vagas.release()
+            raise
+
+    def devolver(self, conn, descartar=False):
+        try:
+            if descartar or conn.closed:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            else:
+                with self._lock:
+                    self._livres.append(conn)
+        finally:
+            self._vagas.release()
+
+
+_pool = _Pool(
+    os.getenv('DATABASE_URL'),
+    tamanho=int(os.getenv('DB_POOL_MAX', 5)),
+    espera=float(os.getenv('DB_POOL_ESPERA', 2)),
+)
+
+# Erros que podem indicar conexão derrubada (ex: o servidor fechou uma conexão parada
+# no pool). QueryCanceled, DeadlockDetected etc. também são OperationalError, por isso
+# quem pega estes erros confere _conexao_perdida antes de descartar a conexão.
+_ERROS_DE_CONEXAO = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def _conexao_perdida(conn, erro):
+    """True só se a conexão caiu de fato; erros do servidor (com pgcode) não contam."""
+    return bool(conn.closed) or getattr(erro, 'pgcode', None) is None
+
+def _pegar_conexao():
+    try:
+        return _pool.pegar()
+    except BancoOcupado:
+        raise
+    except Exception as e:
+        print(f"ERRO CRÍTICO: Não foi possível conectar ao banco de dados: {e}")
+        raise
+
+def _devolver_conexao(conn, descartar=False):
+    _pool.devolver(conn, descartar)
+
+
+def _executar(conn, nome, params):
+    cur = conn.cursor()
+    if nome not in conn.preparadas:
+        cur.execute(f'PREPARE {nome} AS {CONSULTAS[nome]}')
+        conn.preparadas.add(nome)
+    if params:
+        cur.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f'EXECUTE {nome}')
+    return cur
+
+def _consultar(nome, params, quantidade):
+    for tentativa in (1, 2):
+        conn = _pegar_conexao()
+        descartar = False
+        inicio = time.perf_counter()
+        try:
+            try:
+                cur = _executar(conn, nome, params)
+            except psycopg2.errors.FeatureNotSupported:
+                # "cached plan must not change result type": a tabela mudou desde o PREPARE
+                conn.cursor().execute(f'DEALLOCATE {nome}')
+                conn.preparadas.discard(nome)
+                cur = _executar(conn, nome, params)
+
+            classe = _classe_registro(nome, cur.description)
+            if quantidade == 1:
+                linha = cur.fetchone()
+                resultado = classe(linha) if linha else None
+            else:
+                resultado = [classe(linha) for linha in cur.fetchall()]
+            cur.close()
+            return resultado
+        except _ERROS_DE_CONEXAO as e:
+            # Erro do servidor (timeout, deadlock...): a conexão está boa, volta ao pool
+            if not _conexao_perdida(conn, e):
+                raise
+            # Conexão caiu: descarta e tenta uma vez com outra (nova, se preciso)
+            descartar = True
+            if tentativa == 2:
+                raise
+            print(f"AVISO: Conexão com o banco perdida em '{nome}', tentando de novo.")
+        finally:
+            metricas.registrar_tempo(f'sql.{nome}', time.perf_counter() - inicio)
+            _devolver_conexao(conn, descartar)
+
+def buscar_um(nome, *params):
+    """Executa a consulta preparada 'nome' e retorna o primeiro registro, ou None."""
+    return _consultar(nome, params, 1)
+
+def buscar_todos(nome, *params):
+    """Executa a consulta preparada 'nome' e retorna todos os registros."""
+    return _consultar(nome, params, None)
+
+def _abrir_cursor(nome, lote):
+    """Abre o cursor no servidor e lê o primeiro lote; tenta de novo uma vez se a conexão caiu."""
+    for tentativa in (1, 2):
+        conn = _pegar_conexao()
+        inicio = time.perf_counter()
+        try:
+            conn.autocommit = False
+            cur = conn.cursor(name=f'cursor_{nome}')
+            cur.execute(CONSULTAS[nome])
+            linhas = cur.fetchmany(lote)
+            return conn, cur, linhas, time.perf_counter() - inicio
+        except _ERROS_DE_CONEXAO as e:
+            if not _conexao_perdida(conn, e):
+                _encerrar_cursor(conn, descartar=False)
+                raise
+            _devolver_conexao(conn, descartar=True)
+            if tentativa == 2:
+                raise
+            print(f"AVISO: Conexão com o banco perdida em '{nome}', tentando de novo.")
+        except Exception:
+            _encerrar_cursor(conn, descartar=False)
+            raise
+
+def _encerrar_cursor(conn, descartar):
+    # Fecha a transação do cursor nomeado e volta a conexão para autocommit
+    if not descartar and not conn.closed:
+        try:
+            conn.rollback()
+            conn.autocommit = True
+        except _ERROS_DE_CONEXAO:
+            descartar = True
+    _devolver_conexao(conn, descartar)
+
+@contextmanager
+def iterar(nome, lote=500):
+    """
+    Lê a consulta 'nome' em lotes por um cursor no servidor, sem fetchall().
+
+        with banco.iterar('blog_slugs') as posts:
+            for post in posts: ...
+
+    A conexão volta ao pool ao sair do 'with', mesmo que o loop pare antes do fim,
+    e o tempo registrado conta só o execute/fetchmany, não o corpo do loop.
+
+    O Postgres não aceita DECLARE ... FOR EXECUTE, então aqui o cursor nomeado
+    roda o texto da consulta (sem parâmetros); o plano fica no próprio cursor.
+    """
+    conn, cur, primeiro_lote, tempo = _abrir_cursor(nome, lote)
+    descartar = False
+
+    def registros():
+        nonlocal tempo
+        linhas = primeiro_lote
+        classe = _classe_registro(nome, cur.description) if linhas else None
+        while linhas:
+            for linha in linhas:
+                yield classe(linha)
+            inicio = time.perf_counter()
+            linhas = cur.fetchmany(lote)
+            tempo += time.perf_counter() - inicio
+
+    try:
+        yield registros()
+    except _ERROS_DE_CONEXAO as e:
+        descartar = _conexao_perdida(conn, e)
+        raise
+    finally:
+        metricas.registrar_tempo(f'sql.{nome}', tempo)
+        _encerrar_cursor(conn, descartar)
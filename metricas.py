@@ -0,0 +1,44 @@
+import threading
+
+
+class Metricas:
+    """Contadores e tempos simples, por processo, expostos em /api/metricas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._tempos = {}
+
+    def incrementar(self, nome, valor=1):
+        with self._lock:
+            self._contadores[nome] = self._contadores.get(nome, 0) + valor
+
+    def registrar_tempo(self, nome, segundos):
+        """Acumula uma medição de duração (ex: tempo de uma consulta SQL)."""
+        with self._lock:
+            tempo = self._tempos.get(nome)
+            if tempo is None:
+                tempo = self._tempos[nome] = [0, 0.0, 0.0]
+            tempo[0] += 1
+            tempo[1] += segundos
+            tempo[2] = max(tempo[2], segundos)
+
+    def resumo(self):
+        """Retorna uma cópia dos valores atuais, pronta para jsonify."""
+        with self._lock:
+            return {
+                'contadores': dict(sorted(self._contadores.items())),
+                'tempos': {
+                    nome: {
+                        'chamadas': chamadas,
+                        'total_ms': round(total * 1000, 2),
+                        'media_ms': round(total * 1000 / chamadas, 2),
+                        'max_ms': round(maximo * 1000, 2),
+                    }
+                    for nome, (chamadas, total, maximo) in sorted(self._tempos.items())
+                },
+            }
+
+
+# Instância única compartilhada pelos módulos do app
+metricas = Metricas()
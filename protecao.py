@@ -0,0 +1,280 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import jsonify, make_response, request
+
+from metricas import metricas
+
+
+class EsperaEsgotada(Exception):
+    """A chamada líder do SingleFlight não terminou dentro da espera máxima."""
+
+
+class SingleFlight:
+    """
+    Junta chamadas idênticas em andamento numa só execução.
+
+    A primeira thread que pede uma chave executa a função; as que chegam
+    enquanto ela roda esperam e recebem o mesmo resultado (ou a mesma exceção).
+    Quem espera mais que 'espera' segundos desiste com EsperaEsgotada, para não
+    prender uma thread do worker atrás de uma líder travada.
+    Nada fica guardado depois que a chamada termina.
+    """
+
+    class _Chamada:
+        __slots__ = ('evento', 'resultado', 'erro')
+
+        def __init__(self):
+            self.evento = threading.Event()
+            self.resultado = None
+            self.erro = None
+
+    def __init__(self, espera=None):
+        self._lock = threading.Lock()
+        self._em_andamento = {}
+        self._espera = espera
+
+    def executar(self, chave, funcao):
+        with self._lock:
+            chamada = self._em_andamento.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = self._em_andamento[chave] = self._Chamada()
+
+        if not lider:
+            metricas.incrementar('coalescidas')
+            if not chamada.evento.wait(self._espera):
+                metricas.incrementar('coalescidas.espera_esgotada')
+                raise EsperaEsgotada(f"Espera esgotada para {chave!r}")
+            if chamada.erro is not None:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = funcao()
+            return chamada.resultado
+        except Exception as e:
+            chamada.erro = e
+            raise
+        finally:
+            with self._lock:
+                del self._em_andamento[chave]
+            chamada.evento.set()
+
+
+class TokenBucket:
+    """Balde de tokens: 'taxa' tokens por segundo, acumulando até 'capacidade'."""
+
+    __slots__ = ('taxa', 'capacidade', 'tokens', 'atualizado_em')
+
+    def __init__(self, taxa, capacidade):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.tokens = capacidade
+        self.atualizado_em = time.monotonic()
+
+    def consumir(self, agora):
+        """Tenta gastar um token. Deve ser chamado com o lock do dono do balde."""
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado_em) * self.taxa)
+        self.atualizado_em = agora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def espera(self):
+        """Segundos até o próximo token ficar disponível."""
+        if self.taxa <= 0:
+            return 60
+        return max(1, int((1 - self.tokens) / self.taxa) + 1)
+
+
+class ControleDeAdmissao:
+    """
+    Orçamento de requisições de um grupo de rotas: um balde global para o grupo
+    e um balde por cliente (IP). Os limites valem por processo do gunicorn.
+    """
+
+    def __init__(self, taxa_rota, capacidade_rota, taxa_cliente, capacidade_cliente, max_clientes=4096):
+        self._lock = threading.Lock()
+        self._rota = TokenBucket(taxa_rota, capacidade_rota)
+        self._taxa_cliente = taxa_cliente
+        self._capacidade_cliente = capacidade_cliente
+        self._max_clientes = max_clientes
+        self._clientes = OrderedDict()
+
+    def admitir(self, cliente):
+        """
+        Retorna (None, 0) se a requisição pode seguir, ou (motivo, espera) com
+        motivo 'cliente' (estourou o balde do IP) ou 'rota' (estourou o do grupo).
+        """
+        agora = time.monotonic()
+        with self._lock:
+            balde = self._clientes.get(cliente)
+            if balde is None:
+                balde = self._clientes[cliente] = TokenBucket(self._taxa_cliente, self._capacidade_cliente)
+                if len(self._clientes) > self._max_clientes:
+                    self._clientes.popitem(last=False)
+            else:
+                self._clientes.move_to_end(cliente)
+
+            if not balde.consumir(agora):
+                return 'cliente', balde.espera()
+            if not self._rota.consumir(agora):
+                # Devolve o token do cliente: a culpa não foi dele
+                balde.tokens += 1
+                return 'rota', self._rota.espera()
+            return None, 0
+
+
+class CacheObsoleto:
+    """
+    Guarda a última resposta boa de cada URL para servir quando houver descarte de carga.
+    Limitado por número de itens e pelo total de bytes dos corpos; sai o menos usado.
+    """
+
+    def __init__(self, max_itens=256, max_bytes=8 * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._max_itens = max_itens
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._itens = OrderedDict()
+
+    def guardar(self, chave, resposta):
+        tamanho = len(resposta[0])
+        with self._lock:
+            antiga = self._itens.pop(chave, None)
+            if antiga is not None:
+                self._bytes -= len(antiga[0])
+            if tamanho > self._max_bytes:
+                return
+            self._itens[chave] = resposta
+            self._bytes += tamanho
+            while len(self._itens) > self._max_itens or self._bytes > self._max_bytes:
+                _, removida = self._itens.popitem(last=False)
+                self._bytes -= len(removida[0])
+
+    def obter(self, chave):
+        with self._lock:
+            resposta = self._itens.get(chave)
+            if resposta is not None:
+                self._itens.move_to_end(chave)
+            return resposta
+
+
+def _env_float(nome, padrao):
+    try:
+        return float(os.getenv(nome, padrao))
+    except ValueError:
+        print(f"AVISO: Valor inválido em {nome}, usando {padrao}.")
+        return float(padrao)
+
+
+# Orçamentos por grupo de rotas. '/api/chat' consome a cota do Gemini, então é bem
+# mais restrito que as páginas, que só batem no Postgres.
+ORCAMENTOS = {
+    'chat': ControleDeAdmissao(
+        taxa_rota=_env_float('CHAT_TAXA_ROTA', 0.2),
+        capacidade_rota=_env_float('CHAT_RAJADA_ROTA', 5),
+        taxa_cliente=_env_float('CHAT_TAXA_CLIENTE', 0.1),
+        capacidade_cliente=_env_float('CHAT_RAJADA_CLIENTE', 3),
+    ),
+    'paginas': ControleDeAdmissao(
+        taxa_rota=_env_float('PAGINAS_TAXA_ROTA', 20),
+        capacidade_rota=_env_float('PAGINAS_RAJADA_ROTA', 40),
+        taxa_cliente=_env_float('PAGINAS_TAXA_CLIENTE', 5),
+        capacidade_cliente=_env_float('PAGINAS_RAJADA_CLIENTE', 15),
+    ),
+}
+
+singleflight = SingleFlight(espera=_env_float('COALESCER_ESPERA_MAX', 10))
+cache_obsoleto = CacheObsoleto(
+    max_itens=int(_env_float('CACHE_OBSOLETO_ITENS', 256)),
+    max_bytes=int(_env_float('CACHE_OBSOLETO_BYTES', 8 * 1024 * 1024)),
+)
+
+
+def _ip_cliente():
+    # O ProxyFix do app já troca remote_addr pelo IP que o proxy do Render anexou
+    return request.remote_addr or 'desconhecido'
+
+
+def _congelar(resposta):
+    """Extrai o conteúdo de uma Response para poder recriá-la em outras requisições."""
+    resposta = make_response(resposta)
+    return resposta.get_data(), resposta.status_code, list(resposta.headers.items())
+
+
+def _recriar(congelada, cabecalhos_extras=None):
+    corpo, status, cabecalhos = congelada
+    resposta = make_response(corpo, status, cabecalhos)
+    if cabecalhos_extras:
+        resposta.headers.update(cabecalhos_extras)
+    return resposta
+
+
+def _resposta_descartada(motivo, espera):
+    status = 429 if motivo == 'cliente' else 503
+    mensagem = 'Muitas requisições. Tente novamente em instantes.'
+    if request.path.startswith('/api/'):
+        resposta = make_response(jsonify({'error': mensagem}), status)
+    else:
+        resposta = make_response(mensagem, status)
+    resposta.headers['Retry-After'] = str(espera)
+    return resposta
+
+
+def _chave(parametros):
+    # Só o caminho e os argumentos que a view lê: outros parâmetros da query string
+    # não podem furar a junção de chamadas nem encher o cache com cópias da mesma página
+    if not parametros:
+        return request.path
+    return f"{request.path}?{urlencode([(nome, request.args.get(nome, '')) for nome in parametros])}"
+
+
+def controle_de_carga(grupo, coalescer=True, parametros=()):
+    """
+    Decorator de rota: aplica o orçamento do grupo, junta renderizações idênticas
+    em andamento (só GET) e, ao descartar carga, serve a última versão boa da página
+    quando houver uma, em vez de 429/503. O mesmo vale para quem desiste de esperar
+    uma renderização idêntica que está demorando demais.
+
+    'parametros' lista os argumentos da query string que a view usa; só eles
+    entram na chave do cache e da junção de chamadas.
+    """
+    orcamento = ORCAMENTOS[grupo]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            chave = _chave(parametros)
+            cacheavel = coalescer and request.method == 'GET'
+
+            def descartar(motivo, espera):
+                metricas.incrementar(f'descartadas.{grupo}.{motivo}')
+                obsoleta = cache_obsoleto.obter(chave) if cacheavel else None
+                if obsoleta:
+                    metricas.incrementar(f'obsoletas.{grupo}')
+                    return _recriar(obsoleta, {'X-Cache': 'STALE'})
+                return _resposta_descartada(motivo, espera)
+
+            motivo, espera = orcamento.admitir(_ip_cliente())
+            if motivo:
+                return descartar(motivo, espera)
+
+            if not cacheavel:
+                return view(*args, **kwargs)
+
+            try:
+                congelada = singleflight.executar(chave, lambda: _congelar(view(*args, **kwargs)))
+            except EsperaEsgotada:
+                return descartar('espera', 1)
+            if congelada[1] == 200:
+                cache_obsoleto.guardar(chave, congelada)
+            return _recriar(congelada)
+        return wrapper
+    return decorator
@@ -0,0 +1,397 @@
+"""
+Snapshot binário dos dados das feiras, compartilhado entre os workers do gunicorn.
+
+Um processo consulta o banco e grava o arquivo; todos os workers abrem o mesmo
+arquivo com mmap somente-leitura, então as páginas ficam uma vez só no cache do
+sistema operacional, não importa quantos workers existam. As colunas são arrays
+de tamanho fixo e os textos ficam numa tabela de strings sem repetição, então
+abrir o snapshot não exige interpretar nenhuma linha.
+
+Layout (ordem de bytes nativa, seções alinhadas em 8 bytes):
+
+    cabeçalho   MAGICO, FORMATO, LAYOUT, esquema, versão, nº de seções
+    diretório   (id do nome, tipo, offset, tamanho) por seção
+    seções      'strings.offsets' (uint32) e 'strings.dados' (utf-8),
+                '<tabela>.colunas' (pares id do nome/tipo, uint32),
+                '<tabela>.<coluna>' e '<tabela>.<coluna>.nulos',
+                'indice.<nome>.chaves' e 'indice.<nome>.linhas' (uint32),
+                'lista.<nome>' (ids de string) e 'texto.<nome>' (utf-8)
+
+O id de string 0 é reservado para None. LAYOUT muda quando este formato muda;
+'esquema' vem de quem publica e muda quando mudam os nomes de tabelas, índices etc.
+Um arquivo com qualquer um dos dois diferente é tratado como inexistente e regerado.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+MAGICO = b'FEIRSNAP'
+FORMATO = 1 if sys.byteorder == 'little' else 2
+LAYOUT = 2
+_CABECALHO = struct.Struct('=8sIIIQI')
+_ENTRADA = struct.Struct('=IIQQ')
+
+# Tipos de coluna e o typecode do array que guarda cada um
+STR, INT, FLOAT, BOOL, JSON = range(5)
+_TYPECODES = {STR: 'I', INT: 'q', FLOAT: 'd', BOOL: 'B', JSON: 'I'}
+
+# Tipos das seções que não são colunas
+_BYTES, _UINT32 = 100, 101
+
+
+def _tipo_coluna(valores):
+    tipos = {type(v) for v in valores if v is not None}
+    if not tipos or tipos == {str}:
+        return STR
+    if tipos == {bool}:
+        return BOOL
+    if tipos == {int}:
+        return INT
+    if tipos <= {int, float}:
+        return FLOAT
+    return JSON
+
+
+class _Escritor:
+    def __init__(self):
+        self._strings = {None: 0}
+        self._lista_strings = [b'']
+        self._secoes = []
+
+    def string(self, valor):
+        """Interna um texto e retorna seu id."""
+        id_string = self._strings.get(valor)
+        if id_string is None:
+            id_string = self._strings[valor] = len(self._lista_strings)
+            self._lista_strings.append(valor.encode('utf-8'))
+        return id_string
+
+    def secao(self, nome, tipo, dados):
+        self._secoes.append((nome, tipo, dados))
+
+    def tabela(self, nome, linhas):
+        colunas = []
+        for linha in linhas:
+            for coluna in linha:
+                if coluna not in colunas:
+                    colunas.append(coluna)
+
+        meta = array('I')
+        for coluna in colunas:
+            valores = [linha.get(coluna) for linha in linhas]
+            tipo = _tipo_coluna(valores)
+            meta.extend((self.string(coluna), tipo))
+
+            if tipo == STR:
+                dados = array('I', (0 if v is None else self.string(str(v)) for v in valores))
+            elif tipo == JSON:
+                dados = array('I', (0 if v is None else self.string(json.dumps(v, default=str)) for v in valores))
+            else:
+                dados = array(_TYPECODES[tipo], (0 if v is None else v for v in valores))
+                if None in valores:
+                    self.secao(f'{nome}.{coluna}.nulos', _BYTES, bytes(v is None for v in valores))
+            self.secao(f'{nome}.{coluna}', tipo, dados.tobytes())
+        self.secao(f'{nome}.colunas', _UINT32, meta.tobytes())
+
+    def indice(self, nome, chaves):
+        """Índice chave -> nº da linha. Em chaves repetidas vale a primeira linha."""
+        primeiras = {}
+        for linha, chave in enumerate(chaves):
+            if chave not in (None, '') and chave not in primeiras:
+                primeiras[chave] = linha
+        ordenadas = sorted(primeiras)
+        self.secao(f'indice.{nome}.chaves', _UINT32, array('I', (self.string(c) for c in ordenadas)).tobytes())
+        self.secao(f'indice.{nome}.linhas', _UINT32, array('I', (primeiras[c] for c in ordenadas)).tobytes())
+
+    def lista(self, nome, valores):
+        self.secao(f'lista.{nome}', _UINT32, array('I', (self.string(v) for v in valores)).tobytes())
+
+    def texto(self, nome, valor):
+        self.secao(f'texto.{nome}', _BYTES, valor.encode('utf-8'))
+
+    def gravar(self, arquivo, esquema, versao):
+        # Os nomes das seções também vão para a tabela de strings
+        secoes = [(self.string(nome), tipo, dados) for nome, tipo, dados in self._secoes]
+        id_offsets, id_dados = self.string('strings.offsets'), self.string('strings.dados')
+
+        offsets = array('I', [0])
+        for s in self._lista_strings:
+            offsets.append(offsets[-1] + len(s))
+        secoes.insert(0, (id_offsets, _UINT32, offsets.tobytes()))
+        secoes.insert(1, (id_dados, _BYTES, b''.join(self._lista_strings)))
+
+        posicao = _alinhar(_CABECALHO.size + _ENTRADA.size * len(secoes))
+        diretorio = []
+        for id_nome, tipo, dados in secoes:
+            diretorio.append(_ENTRADA.pack(id_nome, tipo, posicao, len(dados)))
+            posicao = _alinhar(posicao + len(dados))
+
+        arquivo.write(_CABECALHO.pack(MAGICO, FORMATO, LAYOUT, esquema, versao, len(secoes)))
+        arquivo.write(b''.join(diretorio))
+        for _, _, dados in secoes:
+            arquivo.write(b'\0' * (_alinhar(arquivo.tell()) - arquivo.tell()))
+            arquivo.write(dados)
+
+
+def _alinhar(n):
+    return (n + 7) & ~7
+
+
+def escrever_snapshot(caminho, tabelas, indices=None, listas=None, textos=None, esquema=0):
+    """
+    Grava um novo snapshot e o publica de forma atômica (arquivo temporário + rename).
+
+    tabelas: {nome: [dict, ...]}
+    indices: {nome: (tabela, coluna)}, para buscar linhas por chave
+    listas:  {nome: [str, ...]}
+    textos:  {nome: str}
+    """
+    escritor = _Escritor()
+    for nome, linhas in tabelas.items():
+        escritor.tabela(nome, linhas)
+    for nome, (tabela, coluna) in (indices or {}).items():
+        escritor.indice(nome, [None if l.get(coluna) is None else str(l.get(coluna)) for l in tabelas[tabela]])
+    for nome, valores in (listas or {}).items():
+        escritor.lista(nome, valores)
+    for nome, valor in (textos or {}).items():
+        escritor.texto(nome, valor)
+
+    versao = time.time_ns()
+    temporario = f'{caminho}.{os.getpid()}.tmp'
+    try:
+        with open(temporario, 'wb') as arquivo:
+            escritor.gravar(arquivo, esquema, versao)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, caminho)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+    return versao
+
+
+class Snapshot:
+    """
+    Leitura de um snapshot via mmap. Nada é copiado para o processo até ser acessado.
+
+    Levanta ValueError (ou struct.error) se o arquivo estiver vazio, truncado,
+    corrompido ou for de outro formato/esquema.
+    """
+
+    def __init__(self, caminho, esquema=0):
+        with open(caminho, 'rb') as arquivo:
+            self.stat = os.fstat(arquivo.fileno())
+            # mmap de arquivo vazio já levanta ValueError
+            self._mmap = mmap.mmap(arquivo.fileno(), 0, access=mmap.ACCESS_READ)
+        memoria = memoryview(self._mmap)
+
+        magico, formato, layout, esquema_arquivo, self.versao, n_secoes = _CABECALHO.unpack_from(memoria, 0)
+        if magico != MAGICO or formato != FORMATO or layout != LAYOUT or esquema_arquivo != esquema:
+            raise ValueError(f"Snapshot inválido ou de outro formato: {caminho}")
+
+        entradas = [_ENTRADA.unpack_from(memoria, _CABECALHO.size + i * _ENTRADA.size) for i in range(n_secoes)]
+        if len(entradas) < 2 or any(offset + tamanho > len(memoria) for _, _, offset, tamanho in entradas):
+            raise ValueError(f"Snapshot truncado: {caminho}")
+        # As duas primeiras seções são sempre a tabela de strings
+        self._offsets = memoria[entradas[0][2]:entradas[0][2] + entradas[0][3]].cast('I')
+        self._dados = memoria[entradas[1][2]:entradas[1][2] + entradas[1][3]]
+
+        self._secoes = {}
+        for id_nome, tipo, offset, tamanho in entradas:
+            bruto = memoria[offset:offset + tamanho]
+            if tipo in _TYPECODES:
+                bruto = bruto.cast(_TYPECODES[tipo])
+            elif tipo == _UINT32:
+                bruto = bruto.cast('I')
+            self._secoes[self.string(id_nome)] = bruto
+        self._tabelas = {}
+
+    def string(self, id_string):
+        if not id_string:
+            return None
+        return str(self._dados[self._offsets[id_string]:self._offsets[id_string + 1]], 'utf-8')
+
+    def tabela(self, nome):
+        tabela = self._tabelas.get(nome)
+        if tabela is None:
+            tabela = self._tabelas[nome] = Tabela(self, nome)
+        return tabela
+
+    def buscar(self, indice, chave):
+        """Retorna o nº da linha para a chave, ou None. Busca binária sobre as chaves ordenadas."""
+        chaves = self._secoes[f'indice.{indice}.chaves']
+        inicio, fim = 0, len(chaves)
+        while inicio < fim:
+            meio = (inicio + fim) // 2
+            if self.string(chaves[meio]) < chave:
+                inicio = meio + 1
+            else:
+                fim = meio
+        if inicio < len(chaves) and self.string(chaves[inicio]) == chave:
+            return self._secoes[f'indice.{indice}.linhas'][inicio]
+        return None
+
+    def chaves(self, indice):
+        return [self.string(c) for c in self._secoes[f'indice.{indice}.chaves']]
+
+    def lista(self, nome):
+        return [self.string(i) for i in self._secoes[f'lista.{nome}']]
+
+    def texto(self, nome):
+        return str(self._secoes[f'texto.{nome}'], 'utf-8')
+
+
+class Tabela:
+    """Visão colunar de uma tabela do snapshot; as linhas viram dict só quando pedidas."""
+
+    def __init__(self, snapshot, nome):
+        self._snapshot = snapshot
+        secoes = snapshot._secoes
+        meta = secoes[f'{nome}.colunas']
+        self.colunas = []
+        self._dados = {}
+        for i in range(0, len(meta), 2):
+            coluna, tipo = snapshot.string(meta[i]), meta[i + 1]
+            self.colunas.append(coluna)
+            self._dados[coluna] = (tipo, secoes[f'{nome}.{coluna}'], secoes.get(f'{nome}.{coluna}.nulos'))
+        self._tamanho = len(self._dados[self.colunas[0]][1]) if self.colunas else 0
+
+    def __len__(self):
+        return self._tamanho
+
+    def valor(self, linha, coluna):
+        tipo, dados, nulos = self._dados[coluna]
+        if nulos is not None and nulos[linha]:
+            return None
+        valor = dados[linha]
+        if tipo == STR:
+            return self._snapshot.string(valor)
+        if tipo == JSON:
+            return json.loads(self._snapshot.string(valor)) if valor else None
+        if tipo == BOOL:
+            return bool(valor)
+        return valor
+
+    def linha(self, linha):
+        return {coluna: self.valor(linha, coluna) for coluna in self.colunas}
+
+    def linhas(self):
+        for i in range(self._tamanho):
+            yield self.linha(i)
+
+    def buscar(self, indice, chave):
+        linha = self._snapshot.buscar(indice, chave)
+        return None if linha is None else self.linha(linha)
+
+
+# O que um arquivo vazio, truncado ou de outro formato/esquema pode levantar ao ser aberto
+_ERROS_DE_ARQUIVO = (ValueError, struct.error, KeyError, IndexError, TypeError)
+
+
+class SnapshotCompartilhado:
+    """
+    Mantém o snapshot mais recente mapeado neste worker.
+
+    A cada 'intervalo' segundos confere se o arquivo mudou (stat) e, se mudou, mapeia
+    o novo e troca a referência; quem ainda usa o antigo continua lendo normalmente.
+    Se o arquivo não existe, não abre (corrompido, truncado, de outro esquema) ou
+    passou de 'max_idade', um único processo (flock) chama 'publicar' para gerar
+    outro; os demais seguem com o que já têm.
+    """
+
+    def __init__(self, caminho, publicar, max_idade=900, intervalo=5, esquema=0):
+        self.caminho = caminho
+        self.esquema = esquema
+        self._publicar = publicar
+        self._max_idade = max_idade
+        self._intervalo = intervalo
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._conferido_em = 0
+        self._republicando = False
+
+    def atual(self):
+        agora = time.monotonic()
+        if self._snapshot is not None and agora - self._conferido_em < self._intervalo:
+            return self._snapshot
+
+        with self._lock:
+            if self._snapshot is None or agora - self._conferido_em >= self._intervalo:
+                self._conferido_em = agora
+                self._recarregar()
+        if self._snapshot is None:
+            raise RuntimeError(f"Snapshot de dados indisponível em {self.caminho}")
+        return self._snapshot
+
+    def _recarregar(self):
+        try:
+            stat = os.stat(self.caminho)
+        except FileNotFoundError:
+            # Ninguém publicou ainda: espera quem estiver publicando ou publica
+            self._publicar_com_trava(bloquear=True, ja_publicado=lambda: os.path.exists(self.caminho))
+            stat = os.stat(self.caminho)
+
+        atual = self._snapshot
+        if atual is None or self._identidade(stat) != self._identidade(atual.stat):
+            try:
+                novo = Snapshot(self.caminho, self.esquema)
+            except _ERROS_DE_ARQUIVO as e:
+                # Arquivo ruim conta como inexistente: republica (a menos que outro
+                # processo já tenha trocado o arquivo enquanto esperávamos a trava)
+                print(f"AVISO: Snapshot de dados inválido ({e!r}), publicando outro.")
+                ruim = self._identidade(stat)
+                self._publicar_com_trava(
+                    bloquear=True,
+                    ja_publicado=lambda: self._identidade(os.stat(self.caminho)) != ruim,
+                )
+                stat = os.stat(self.caminho)
+                novo = Snapshot(self.caminho, self.esquema)
+            self._snapshot = novo
+            print(f"Snapshot de dados mapeado: versão {self._snapshot.versao}")
+
+        if self._max_idade and self._idade() > self._max_idade and not self._republicando:
+            self._republicando = True
+            threading.Thread(target=self._republicar, daemon=True).start()
+
+    @staticmethod
+    def _identidade(stat):
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _idade(self):
+        return time.time() - os.path.getmtime(self.caminho)
+
+    def _republicar(self):
+        try:
+            self._publicar_com_trava(bloquear=False, ja_publicado=lambda: self._idade() < self._max_idade)
+        except Exception as e:
+            print(f"ERRO ao republicar o snapshot de dados: {e}")
+        finally:
+            self._republicando = False
+
+    def _publicar_com_trava(self, bloquear, ja_publicado):
+        with open(f'{self.caminho}.lock', 'a') as trava:
+            try:
+                fcntl.flock(trava, fcntl.LOCK_EX if bloquear else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                # Outro processo pode ter publicado enquanto esperávamos a trava
+                if not ja_publicado():
+                    self._publicar()
+            finally:
+                fcntl.flock(trava, fcntl.LOCK_UN)
+
+    def publicar(self):
+        """Força uma nova publicação (usado pelo comando 'flask publicar-snapshot')."""
+        with open(f'{self.caminho}.lock', 'a') as trava:
+            fcntl.flock(trava, fcntl.LOCK_EX)
+            try:
+                self._publicar()
+            finally:
+                fcntl.flock(trava, fcntl.LOCK_UN)